@@ -1,15 +1,8 @@
-from concurrent.futures import ThreadPoolExecutor
-from substrateinterface import SubstrateInterface
+from get_state import OUTPUT, connect_to_remote_chain, determine_node_version
 import subprocess
-import json
-import threading
-import xxhash
-import os
 import argparse
 import yaml
 
-FORK_SPEC, RAW_STORAGE = "./output/fork.json", "./output/raw_storage.json"
-
 
 def parse_args():
     parser = argparse.ArgumentParser()
@@ -25,40 +18,6 @@ def parse_args():
     return (configuration, release_candidate)
 
 
-def connect_to_remote_chain(url) -> SubstrateInterface:
-    substrate = SubstrateInterface(url=url)
-    substrate.init_runtime()
-    chain_name = substrate.rpc_request('system_chain', None)['result']
-
-    return (substrate, chain_name)
-
-
-def determine_node_version(substrate: SubstrateInterface, hash: str):
-    client_version = substrate.rpc_request('system_version', None)[
-        'result'].split('.')[0]
-    runtime_version = substrate.rpc_request(method='state_getRuntimeVersion', params=[hash])[
-        'result']['specVersion']
-
-    version = f'v{client_version}.{runtime_version}.0'
-    all_tags = subprocess.run(
-        'git tag', shell=True, text=True, check=True, capture_output=True).stdout
-    all_tags = all_tags.splitlines()
-
-    # If the version is not found then we need to do some magic
-    if version not in all_tags:
-        version = ''
-        for tag in all_tags:
-            sub_strings = tag.split('.')
-            if (sub_strings[1] == f'{runtime_version}'):
-                version = tag
-
-    if version == '':
-        print("Wasn't able to find the correct tag")
-        exit(1)
-
-    return version
-
-
 def build_runtime_upgrade_wasm(release_candidate):
     if not release_candidate:
         return None
@@ -130,9 +89,7 @@ def main():
     node_version = determine_node_version(substrate, hash)
     print(f"Node version: {node_version}")
 
-    if not os.path.exists('./output'):
-        os.mkdir('./output')
-        print("Created output directory: ./output")
+    OUTPUT.mkdir(exist_ok=True)
 
     build_runtime = build_runtime_upgrade_wasm(release_candidate)
 
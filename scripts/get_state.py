@@ -1,164 +1,234 @@
 from concurrent.futures import ThreadPoolExecutor
 from substrateinterface import SubstrateInterface
+from pathlib import Path
 import subprocess
-import json
+import functools
+import orjson
+import msgpack
+import queue
 import threading
+import itertools
+import websocket
 import xxhash
-import os
 import argparse
 import yaml
-import sys
+import struct
 
-FORK_SPEC, RAW_STORAGE = "./output/fork.json", "./output/raw_storage.json"
+OUTPUT = Path('./output')
+FORK_SPEC, RAW_STORAGE = OUTPUT / 'fork.json', OUTPUT / 'raw_storage.msgpack'
 
-def fetch_paged_storage_keys(substrate, prefix, hash, start_key, prev_keys):
-    if prev_keys is None:
-        keys = []
-    else:
-        keys = prev_keys
+# Importing these modules will cause the chain to not work correctly
+SKIP_MODULES = frozenset(['System', 'Session', 'Babe', 'Grandpa',
+                          'GrandpaFinality', 'FinalityTracker', 'Authorship'])
 
-    rpc_result = substrate.rpc_request(method='state_getKeysPaged', params={
-        "prefix": prefix, "count": 1000, "start_key": start_key, "hash": hash, })['result']
+# '0x' followed by the twox128 hash of the module name
+MODULE_PREFIX_LEN = 34
 
-    if rpc_result:
-        keys += rpc_result
+# We definitely want to keep System.Account data and the Runtime :)
+ENABLED_PREFIXES = (
+    '0x26aa394eea5630e07c48ae0c9558cef7b99d880ec681799c0cf30e8886371da9', '0x3a636f6465')
 
-    if len(rpc_result) == 1000:
-        return fetch_paged_storage_keys(substrate, prefix, hash, rpc_result[-1], keys)
+def rpc_batch(ws, calls):
+    # Send all the calls as one JSON-RPC batch and return their results in the same order
+    ws.send(orjson.dumps([{"jsonrpc": "2.0", "id": i, "method": method, "params": params}
+                          for i, (method, params) in enumerate(calls)]))
+    replies = orjson.loads(ws.recv())
 
-    return keys
+    # A rejected batch (e.g. too large or unsupported) comes back as a single error object
+    if not isinstance(replies, list):
+        raise Exception(replies.get('error', replies) if isinstance(replies, dict) else replies)
 
-def fetch_storage_keys_task(hash, keys, prefixes, lock, url):
-    substrate = SubstrateInterface(url=url)
-    rpc_result = []
-
-    while True:
-        lock.acquire()
-        if rpc_result:
-            keys += rpc_result
+    for reply in replies:
+        if 'error' in reply:
+            raise Exception(reply['error'])
 
-        if not prefixes:
-            lock.release()
-            return
+    # Every call must have exactly one reply, otherwise results would silently go missing
+    replies_by_id = {reply.get('id'): reply for reply in replies}
+    if len(replies) != len(calls) or set(replies_by_id) != set(range(len(calls))):
+        raise Exception(
+            f"Expected replies for ids 0..{len(calls) - 1}, got ids {[reply.get('id') for reply in replies]}")
 
-        prefix = prefixes.pop()
-        lock.release()
+    return [replies_by_id[i]['result'] for i in range(len(calls))]
 
+def put_keys(keys, page, abort):
+    # Gives up once the value workers have failed, nothing would drain the queue anymore
+    while not abort.is_set():
         try:
-            rpc_result = fetch_paged_storage_keys(substrate, prefix, hash, None, None)
-        except Exception as e:
-            print("An error occurred while fetching keys: ", e)
-            exit(-1)
+            keys.put(page, timeout=1)
+            return True
+        except queue.Full:
+            pass
 
-def fetch_storage_keys(hash, url):
-    keys = []
-    prefixes = [f'0x{hex(i)[2:].zfill(2)}' for i in range(256)]
-    lock = threading.Lock()
+    return False
 
-    with ThreadPoolExecutor(max_workers=20) as executor:
-        for _ in range(20):
-            executor.submit(fetch_storage_keys_task,
-                            hash, keys, prefixes, lock, url)
+def fetch_storage_keys_task(hash, prefixes, keys, abort, url):
+    ws = websocket.create_connection(url)
+    key_count = 0
 
-    return keys
+    # Page through all the prefixes of the group at once, one batch request per page round.
+    # 1000 is the most keys a node returns per page.
+    start_keys = dict.fromkeys(prefixes)
 
+    try:
+        while start_keys:
+            pages = rpc_batch(ws, [('state_getKeysPaged', [prefix, 1000, start_key, hash])
+                                   for (prefix, start_key) in start_keys.items()])
 
-def fetch_storage_values_task(hash, lock, keys, key_values, url):
-    substrate = SubstrateInterface(url=url)
+            for (prefix, page) in zip(list(start_keys), pages):
+                if page:
+                    if not put_keys(keys, page, abort):
+                        return key_count
+                    key_count += len(page)
 
-    while True:
-        lock.acquire()
-        keys_to_fetch = [keys.pop() for _ in range(min(1000, len(keys)))]
-        if not keys_to_fetch:
-            lock.release()
-            return
-        lock.release()
+                if len(page) == 1000:
+                    start_keys[prefix] = page[-1]
+                else:
+                    del start_keys[prefix]
+    except Exception as e:
+        print("An error occurred while fetching keys: ", e)
+        exit(-1)
+    finally:
+        ws.close()
 
-        try:
-            key_values_result = substrate.rpc_request(method='state_queryStorageAt', params={
-                "keys": keys_to_fetch, "at": hash})['result'][0]['changes']
+    return key_count
 
-            for i, kv in enumerate(key_values_result):
-                if kv[1] is None:
-                    kv[1] = substrate.rpc_request(method='state_getStorage', params={
-                        "key": kv[0], "hash": hash})['result']
-        except Exception as e:
-            print("An error occurred while fetching values: ", e)
-            exit(-1)
 
-        lock.acquire()
-        key_values += key_values_result
-        lock.release()
+def fetch_storage_values_task(hash, keys, abort, url):
+    ws = websocket.create_connection(url)
+    key_values = []
+    pending_keys = []
+    end_of_keys = False
+
+    try:
+        while True:
+            # Merge queued pages into full batches, the last page of every prefix is usually short.
+            # `None` marks the end of the keys, no end marker comes once another value worker has failed.
+            while not end_of_keys and len(pending_keys) < 1000:
+                try:
+                    page = keys.get(timeout=1) if not pending_keys else keys.get_nowait()
+                except queue.Empty:
+                    if pending_keys or abort.is_set():
+                        break
+                    continue
+
+                if page is None:
+                    end_of_keys = True
+                else:
+                    pending_keys.extend(page)
+
+            if not pending_keys:
+                return key_values
+
+            keys_to_fetch = pending_keys[:1000]
+            del pending_keys[:1000]
+
+            try:
+                [change_sets] = rpc_batch(ws, [('state_queryStorageAt', [keys_to_fetch, hash])])
+                key_values_result = change_sets[0]['changes']
+
+                # Fall back to state_getStorage for the missing values, one batch request for all of them
+                null_kvs = [kv for kv in key_values_result if kv[1] is None]
+                if null_kvs:
+                    values = rpc_batch(ws, [('state_getStorage', [kv[0], hash]) for kv in null_kvs])
+                    for (kv, value) in zip(null_kvs, values):
+                        kv[1] = value
+            except Exception as e:
+                print("An error occurred while fetching values: ", e)
+                exit(-1)
+
+            key_values += key_values_result
+    finally:
+        ws.close()
+
+
+def fetch_storage(hash, url):
+    # 16 groups of 16 one-byte prefixes, each group is fetched by one worker
+    prefixes = [f'0x{hex(i)[2:].zfill(2)}' for i in range(256)]
+    prefix_groups = [prefixes[i:i + 16] for i in range(0, 256, 16)]
 
+    # Values are fetched while the keys are still coming in. Bounded to ~50k keys in flight.
+    keys = queue.Queue(maxsize=50)
+    # Set as soon as a value worker fails, so that the key workers stop filling the queue
+    abort = threading.Event()
 
-def fetch_storage_values(hash, keys, url):
-    key_values = []
-    lock = threading.Lock()
+    def abort_on_failure(future):
+        if future.exception() is not None:
+            abort.set()
 
-    with ThreadPoolExecutor(max_workers=10) as executor:
-        for _ in range(10):
-            executor.submit(fetch_storage_values_task,
-                            hash, lock, keys, key_values, url)
+    with ThreadPoolExecutor(max_workers=10) as values_executor:
+        values_futures = [values_executor.submit(fetch_storage_values_task, hash, keys, abort, url)
+                          for _ in range(10)]
+        for f in values_futures:
+            f.add_done_callback(abort_on_failure)
 
-    with open(RAW_STORAGE, 'w') as outfile:
-        json.dump(key_values, outfile, indent=2)
+        with ThreadPoolExecutor(max_workers=len(prefix_groups)) as keys_executor:
+            keys_futures = [keys_executor.submit(fetch_storage_keys_task, hash, group, keys, abort, url)
+                            for group in prefix_groups]
 
-    return key_values
+        for _ in values_futures:
+            if not put_keys(keys, None, abort):
+                break
 
+    # Raises the failure of a value worker before anything is counted or written
+    key_values = list(itertools.chain.from_iterable(f.result() for f in values_futures))
+    key_count = sum(f.result() for f in keys_futures)
 
-def xxh6464(x):
-    o1 = bytearray(xxhash.xxh64(x, seed=0).digest())
-    o1.reverse()
-    o2 = bytearray(xxhash.xxh64(x, seed=1).digest())
-    o2.reverse()
-    return "0x{}{}".format(o1.hex(), o2.hex())
+    # Written pair by pair so that the packed snapshot never sits in memory next to `key_values`
+    packer = msgpack.Packer()
+    with open(RAW_STORAGE, 'wb') as outfile:
+        outfile.write(packer.pack_array_header(len(key_values)))
+        for kv in key_values:
+            outfile.write(packer.pack(kv))
 
+    return (key_count, key_values)
 
-def list_of_prefixes_to_migrate(substrate):
-    # Importing these modules will cause the chain to not work correctly
-    skip_modules = ['System', 'Session', 'Babe', 'Grandpa',
-                    'GrandpaFinality', 'FinalityTracker', 'Authorship']
 
-    # We definitely want to keep System.Account data and the Runtime :)
-    enabled_prefixes = [
-        '0x26aa394eea5630e07c48ae0c9558cef7b99d880ec681799c0cf30e8886371da9', '0x3a636f6465']
+def xxh6464(x):
+    # Twox128: both 64-bit hashes laid out little-endian, back to back.
+    data = x.encode()
+    h0 = xxhash.xxh64_intdigest(data, seed=0)
+    h1 = xxhash.xxh64_intdigest(data, seed=1)
+    return "0x" + struct.pack("<QQ", h0, h1).hex()
 
-    module_list = substrate.get_metadata_modules()
 
-    for module in module_list:
-        name = module['name']
-        if name not in skip_modules:
-            enabled_prefixes.append(xxh6464(name))
+def list_of_prefixes_to_migrate(substrate):
+    module_list = substrate.get_metadata_modules()
 
-    return enabled_prefixes
+    return list(ENABLED_PREFIXES) + [xxh6464(module['name'])
+                                     for module in module_list if module['name'] not in SKIP_MODULES]
 
 
-def allowed_to_migrate(key: str, allow_list):
-    for prefix in allow_list:
-        if key.startswith(prefix):
-            return True
-    return False
+def read_forked_storage():
+    # Yields the [key, value] pairs of RAW_STORAGE one at a time
+    with open(RAW_STORAGE, 'rb') as in_file:
+        unpacker = msgpack.Unpacker(in_file, raw=False)
+        for _ in range(unpacker.read_array_header()):
+            yield unpacker.unpack()
 
 
-def populate_dev_chain(substrate, forked_storage, chain_name):
+def populate_dev_chain(substrate, chain_name):
     # Read base chain specification. This will be populated with new storage.
-    with open(FORK_SPEC) as in_file:
-        base_chain = json.load(in_file)
+    with open(FORK_SPEC, 'rb') as in_file:
+        base_chain = orjson.loads(in_file.read())
         base_storage = base_chain['genesis']['raw']['top']
 
     base_chain['name'] = chain_name + " Fork"
 
-    allowed_prefixes: list[str] = list_of_prefixes_to_migrate(substrate)
+    # Module prefixes all have the same length, so a key matches one of them through a single set lookup.
+    # The few other prefixes (System.Account, :code) are checked with one `str.startswith` call.
+    allowed_prefixes = list_of_prefixes_to_migrate(substrate)
+    module_prefixes = frozenset(p for p in allowed_prefixes if len(p) == MODULE_PREFIX_LEN)
+    other_prefixes = tuple(p for p in allowed_prefixes if len(p) != MODULE_PREFIX_LEN)
 
     # Dev Sudo Key
     sudo_key_prefix = "0x5c0d1176a568c1f92944340dbfed9e9c530ebca703c85910e7164cb7d1c9e47b"
     sudo_key = base_storage[sudo_key_prefix]
 
-    # Migrate storage from Copied to Base storage
-    key: str
-    for (key, value) in forked_storage:
-        if allowed_to_migrate(key, allowed_prefixes):
-            base_storage[key] = value
+    # Migrate storage from Copied to Base storage.
+    # The copied storage is streamed from disk so that it never has to be fully loaded in memory.
+    base_storage.update(
+        kv for kv in read_forked_storage()
+        if kv[0][:MODULE_PREFIX_LEN] in module_prefixes or kv[0].startswith(other_prefixes))
 
     # Let's change the sudo key to be Alith :)
     base_storage[sudo_key_prefix] = sudo_key
@@ -173,8 +243,8 @@ def populate_dev_chain(substrate, forked_storage, chain_name):
     base_storage['0x5f3e4907f716ac89b6347d15ececedcaf7dad0317324aecae8744b87fc95f2f3'] = '0x02'
 
     # Write the updated base chain specification to a file
-    with open(FORK_SPEC, 'w') as outfile:
-        json.dump(base_chain, outfile, indent=2)
+    with open(FORK_SPEC, 'wb') as outfile:
+        outfile.write(orjson.dumps(base_chain))
 
 
 def read_configuration_file():
@@ -196,6 +266,14 @@ def connect_to_remote_chain(url) -> SubstrateInterface:
     return (substrate, chain_name)
 
 
+@functools.lru_cache(maxsize=1)
+def git_tags() -> frozenset[str]:
+    all_tags = subprocess.run(['git', 'for-each-ref', '--format=%(refname:strip=2)', 'refs/tags'],
+                              text=True, check=True, capture_output=True).stdout
+
+    return frozenset(all_tags.splitlines())
+
+
 def determine_node_version(substrate: SubstrateInterface, hash: str) -> str:
     client_version = substrate.rpc_request('system_version', None)[
         'result'].split('.')[0]
@@ -203,17 +281,13 @@ def determine_node_version(substrate: SubstrateInterface, hash: str) -> str:
         'result']['specVersion']
 
     version = f'v{client_version}.{runtime_version}.0'
-    all_tags = subprocess.run(
-        'git tag', shell=True, text=True, check=True, capture_output=True).stdout
-    all_tags = all_tags.splitlines()
+    all_tags = git_tags()
 
-    # If the version is not found then we need to do some magic
+    # If the version is not found then we need to do some magic.
+    # Take the last matching tag in `git tag` order, which sorts by name.
     if version not in all_tags:
-        version = ''
-        for tag in all_tags:
-            sub_strings = tag.split('.')
-            if (sub_strings[1] == f'{runtime_version}'):
-                version = tag
+        version = max((tag for tag in all_tags if tag.split('.')[1] == f'{runtime_version}'),
+                      default='')
 
     if version == '':
         print("Wasn't able to find the correct tag")
@@ -244,10 +318,6 @@ def maybe_do_tag_switch(tag_switch, node_version):
 
 
 def main():
-    # set python recursion limit to 3000, this is required when we query large keyed prefixes for the state keys.
-    # it should give upto 3_000_000 entries per single prefix.
-    sys.setrecursionlimit(3000)
-
     configuration = read_configuration_file()
     url, tag_switch = configuration['endpoint'], configuration['tag_switch']
 
@@ -260,20 +330,18 @@ def main():
     node_version = determine_node_version(substrate, hash)
     print(f"Node version: {node_version}")
 
-    if not os.path.exists('./output'):
-        os.mkdir('./output')
-        print("Created output directory: ./output")
+    OUTPUT.mkdir(exist_ok=True)
 
     tag_switch = maybe_do_tag_switch(tag_switch, node_version)
 
-    print("Fetching storage keys... ", end=None)
-    keys = fetch_storage_keys(hash, url)
-    print(f"Fetched {len(keys)} keys")
-
-    print("Fetching storage values... ", end=None)
-    forked_storage = fetch_storage_values(hash, keys, url)
+    print("Fetching storage keys and values... ", end=None)
+    (key_count, forked_storage) = fetch_storage(hash, url)
+    print(f"Fetched {key_count} keys")
     print(f"Fetched {len(forked_storage)} values")
 
+    # Everything is in RAW_STORAGE now, no need to hold on to it while the node builds
+    del forked_storage
+
     print('Building node')
     cmd = 'cargo build --release --locked --features try-runtime'
     subprocess.run(cmd, shell=True, text=True, check=True)
@@ -283,12 +351,12 @@ def main():
     # cmd = f'./target/release/seed try-runtime on-runtime-upgrade live -s {SNAPSHOT} -u {URL}'
     # subprocess.run(cmd, shell=True, text=True, check=True)
 
-    print('Creating Dev Chain Specification. location: ./output/fork.json')
+    print(f'Creating Dev Chain Specification. location: {FORK_SPEC}')
     cmd = f'./target/release/seed build-spec --chain dev --raw --disable-default-bootnode > {FORK_SPEC}'
     subprocess.run(cmd, shell=True, text=True, check=True)
 
-    print('Populating Dev Specification. location: ./output/fork.json')
-    populate_dev_chain(substrate, forked_storage, chain_name)
+    print(f'Populating Dev Specification. location: {FORK_SPEC}')
+    populate_dev_chain(substrate, chain_name)
 
     if tag_switch is not None:
         (original_branch, use_stash) = tag_switch